@@ -1,7 +1,19 @@
-from machine import Pin, PWM
+try:
+    from machine import Pin, PWM, lightsleep
+    import utime
+except ImportError:
+    # Not running on a Pico, use the simulator backend instead
+    from rpmidi_sim import Pin, PWM, lightsleep
+    import rpmidi_sim as utime
+try:
+    from gc import mem_alloc
+except ImportError:
+    from rpmidi_sim import mem_alloc
 from math import log2, pow
-import utime
-import io
+import binascii
+import gc
+import hashlib
+import os
 
 """
 RPMidi
@@ -45,12 +57,362 @@ IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 ========================================================================================================
 """
 
-import utime
-
 led = Pin(25, Pin.OUT)
 
-class RPMidi:
+LED_SLOT = 16 # Deadline queue slot used to refresh the indicator LEDs
+STREAM_SLOT = 17 # Deadline queue slot used to poll a live input stream
+ARP_SLOT = 18 # Deadline queue slot used to cycle notes sharing an output
+SYNC_SLOT = 19 # Deadline queue slot used to send or check the multi-board sync clock
+
+
+class ScoreError(ValueError):
+    # Song data that failed validation. offset is the byte the problem was found at.
+    def __init__(self, message, offset):
+        ValueError.__init__(self, "%s at offset %d" % (message, offset))
+        self.offset = offset
+
+
+class SongInfo:
+    # What RPMidi.validate() found out about a song
+    def __init__(self, start=0, velocity=False, length=0, duration_ms=0, events=0, notes=0, max_voices=0, channels=0, loops=False):
+        self.start = start # Offset of the first event, after any header
+        self.velocity = velocity # Note-ons carry a velocity byte
+        self.length = length # Bytes, up to and including the end marker
+        self.duration_ms = duration_ms # One pass through the song
+        self.events = events
+        self.notes = notes
+        self.max_voices = max_voices # Most notes sounding at once
+        self.channels = channels # Bitmask of tone generators used
+        self.loops = loops # Ends in 0xe0 rather than 0xf0
+
+
+class SongCache:
+    # Keeps what validate() found out about songs in a file on flash, so replaying one skips the validation
+    # pass. Entries are keyed by a hash of the song bytes and the play_song options that change the result,
+    # ordered least recently played first, and the oldest are dropped once the file would pass max_bytes.
+    # Lookups only reorder the entries in RAM. The file is written when a song is added, or by flush().
+    def __init__(self, path="rpmidi_cache.txt", max_bytes=4096):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lines = [] # "key start velocity length duration_ms events notes max_voices channels loops\n"
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False # Order changed since the file was written
+        self._chunk = bytearray(256)
+        try:
+            with open(path) as f:
+                for line in f:
+                    # A line cut short (say by a power cut on an older version) would read as a different song
+                    fields = line.split()
+                    if line.endswith("\n") and len(fields) == 10 and len(fields[0]) == 32:
+                        self.lines.append(line)
+        except OSError:
+            pass # No cache yet
+
+    def key(self, music, velocity=None, loop_start=None):
+        # Hashing runs in C, so it is much quicker than the byte by byte validation pass it replaces
+        h = hashlib.sha256()
+        if hasattr(music, "read"):
+            music.seek(0)
+            while True:
+                n = music.readinto(self._chunk)
+                if not n:
+                    break
+                h.update(memoryview(self._chunk)[:n])
+            music.seek(0)
+        else:
+            for i in range(0, len(music), 256):
+                h.update(bytes(music[i:i + 256])) # Lists have to be copied to bytes to be hashed
+        h.update(("%r %r" % (velocity, loop_start)).encode())
+        return binascii.hexlify(h.digest()[:16]).decode()
+
+    def get(self, key):
+        # Returns the cached SongInfo, or None
+        for i in range(len(self.lines)):
+            line = self.lines[i]
+            if line.startswith(key):
+                self.hits += 1
+                if i < len(self.lines) - 1:
+                    self.lines.append(self.lines.pop(i)) # Most recently played goes last
+                    self.dirty = True
+                fields = [int(field) for field in line.split()[1:]]
+                info = SongInfo(*fields)
+                info.velocity = bool(info.velocity)
+                info.loops = bool(info.loops)
+                return info
+        self.misses += 1
+        return None
+
+    def put(self, key, info):
+        self.lines.append("%s %d %d %d %d %d %d %d %d %d\n" % (key, info.start, info.velocity, info.length, info.duration_ms,
+                                                             info.events, info.notes, info.max_voices, info.channels, info.loops))
+        size = 0
+        for line in self.lines:
+            size += len(line)
+        while size > self.max_bytes and len(self.lines) > 1:
+            size -= len(self.lines.pop(0))
+        self.save()
+
+    def flush(self):
+        # Write out the play order if lookups changed it
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        # Write a new file and swap it in, so losing power part way through leaves the old one intact
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            for line in self.lines:
+                f.write(line)
+        try:
+            os.rename(temp, self.path)
+        except OSError:
+            os.remove(self.path) # FAT won't rename over an existing file
+            os.rename(temp, self.path)
+        self.dirty = False
+
+
+class StdinSource:
+    # Wraps USB serial stdin in the same any()/readinto() interface machine.UART has. play_stream calls
+    # open() and close() around playback, which turn Ctrl-C off (0x03 is song data) and back on.
     def __init__(self):
+        import sys
+        import select
+        self.stdin = sys.stdin.buffer
+        self.poll = select.poll()
+        self.poll.register(sys.stdin, select.POLLIN)
+        self.byte = bytearray(1)
+
+    def any(self):
+        if hasattr(self.poll, "ipoll"):
+            for event in self.poll.ipoll(0): # MicroPython's ipoll doesn't allocate a result list
+                return 1
+        elif self.poll.poll(0):
+            return 1
+        return 0
+
+    def readinto(self, buf, nbytes=None):
+        # Read whatever is waiting, up to nbytes, so a chord the host sent in one write lands in one pump
+        if nbytes is None:
+            nbytes = len(buf)
+        n = 0
+        while n < nbytes:
+            self.stdin.readinto(self.byte)
+            buf[n] = self.byte[0]
+            n += 1
+            if not self.any():
+                break
+        return n
+
+    def open(self):
+        self._kbd_intr(-1)
+
+    def close(self):
+        self._kbd_intr(3)
+
+    def _kbd_intr(self, char):
+        try:
+            import micropython
+            micropython.kbd_intr(char)
+        except ImportError:
+            pass
+
+
+class StreamBuffer:
+    # Bounded ring buffer between a live input (anything with UART-style any() and readinto()) and the
+    # player. It only reads from the input while it has room, so a full buffer pushes back on the sender.
+    # With midi=True the input is raw MIDI, translated into RPMidi opcodes as it arrives.
+    def __init__(self, source, size=512, midi=False, channels=16):
+        self.source = source
+        self.data = bytearray(size)
+        self.chunk = bytearray(64)
+        self.head = 0 # Next byte to write
+        self.tail = 0 # Next byte to read
+        self.count = 0
+
+        self.underruns = 0 # Times the player ran out of data
+        self.overruns = 0 # Times the buffer was full with input still waiting
+
+        self.midi = midi
+        self.channels = channels # MIDI channels past this have no tone generator and are dropped
+        self._status = 0
+        self._data1 = -1
+        self._last_event = None
+        self._notes = [-1] * 16
+
+    def put(self, byte):
+        self.data[self.head] = byte
+        self.head = (self.head + 1) % len(self.data)
+        self.count += 1
+
+    def get(self):
+        byte = self.data[self.tail]
+        self.tail = (self.tail + 1) % len(self.data)
+        self.count -= 1
+        return byte
+
+    def unget(self):
+        # Put back the byte get() just returned
+        self.tail = (self.tail - 1) % len(self.data)
+        self.count += 1
+
+    def pump(self):
+        # Move whatever input is waiting into the buffer without blocking
+        waiting = self.source.any()
+        if not waiting:
+            return 0
+        free = len(self.data) - self.count
+        if self.midi:
+            # Any byte read may complete a message started in an earlier pump, and one byte becomes at most
+            # 3 once translated. Every event in a pump shares one arrival time, so only the first can add a
+            # 2 byte delay in front.
+            free = max(0, free - 2) // 3
+        if free == 0:
+            self.overruns += 1
+            return 0
+        # any() may only say that something is waiting, not how much, so read as much as there's room for
+        n = self.source.readinto(self.chunk, min(free, len(self.chunk)))
+        if not n:
+            return 0
+        if self.midi:
+            now = utime.ticks_ms()
+            for i in range(n):
+                self.translate(self.chunk[i], now)
+        else:
+            for i in range(n):
+                self.put(self.chunk[i])
+        return n
+
+    def translate(self, byte, now):
+        # Turn raw MIDI note on/off into 0x9t note velocity / 0x8t events, with delays from arrival times
+        if byte >= 0xf8: # Realtime messages can appear anywhere
+            if byte == 0xfc: # MIDI Stop ends the song
+                self.put(0xf0)
+            return
+        if byte & 0x80:
+            self._status = byte
+            self._data1 = -1
+            return
+        kind = self._status & 0xf0
+        if kind != 0x80 and kind != 0x90:
+            return # Everything else is ignored (this also skips running status for other messages)
+        if self._data1 < 0:
+            self._data1 = byte
+            return
+        note = self._data1
+        self._data1 = -1
+        channel = self._status & 0x0f
+        if channel >= self.channels:
+            return
+        if kind == 0x90 and byte:
+            self._gap(now)
+            self.put(0x90 | channel)
+            self.put(note)
+            self.put(byte)
+            self._notes[channel] = note
+        elif self._notes[channel] == note: # Note off, or note on with velocity 0
+            self._gap(now)
+            self.put(0x80 | channel)
+            self._notes[channel] = -1
+
+    def _gap(self, now):
+        if self._last_event is None:
+            self._last_event = now
+            return
+        gap = utime.ticks_diff(now, self._last_event)
+        self._last_event = now
+        if gap > 0:
+            gap = min(gap, 0x0fff) # Long silences only need to be long enough to notice
+            self.put(gap >> 8)
+            self.put(gap & 0xff)
+
+
+class SyncLeader:
+    # Sends this board's song clock to follower boards over one or more UARTs, every period_ms.
+    # Each frame is 0xa5, the song time in ms (4 bytes, big endian) and an XOR of those 4 bytes.
+    leader = True
+
+    def __init__(self, ports, period_ms=100):
+        if not isinstance(ports, (list, tuple)):
+            ports = [ports]
+        self.ports = ports
+        self.period_ms = period_ms
+        self.frame = bytearray(6)
+        self.frame[0] = 0xa5
+        self.sent = 0
+
+    def send(self, song_ms):
+        frame = self.frame
+        frame[1] = (song_ms >> 24) & 0xff
+        frame[2] = (song_ms >> 16) & 0xff
+        frame[3] = (song_ms >> 8) & 0xff
+        frame[4] = song_ms & 0xff
+        frame[5] = frame[1] ^ frame[2] ^ frame[3] ^ frame[4]
+        for port in self.ports:
+            port.write(frame)
+        self.sent += 1
+
+
+class SyncFollower:
+    # Receives a SyncLeader's song clock. latency_ms is added to every frame for the time it spends on
+    # the wire. period_ms must match the leader's: between frames the follower sleeps until early_ms before
+    # the next one is due, then checks for it every poll_ms. error_ms is how far behind the leader this
+    # board was at the last frame (negative when ahead), max_error_ms the worst seen since the song started.
+    leader = False
+
+    def __init__(self, port, latency_ms=0, poll_ms=1, period_ms=100, early_ms=5):
+        self.port = port
+        self.latency_ms = latency_ms
+        self.poll_ms = poll_ms
+        self.period_ms = period_ms
+        self.early_ms = early_ms
+        self.next_ms = 0 # When the next frame is due
+        self.chunk = bytearray(16)
+        self.frame = bytearray(6)
+        self.have = 0
+        self.received = 0
+        self.rejected = 0
+        self.missed = 0 # Frames that never turned up
+        self.error_ms = 0
+        self.max_error_ms = 0
+
+    def poll(self):
+        # Returns the song time from the newest complete frame waiting, or -1 if there isn't one
+        latest = -1
+        waiting = self.port.any()
+        while waiting:
+            n = self.port.readinto(self.chunk, min(waiting, len(self.chunk)))
+            if not n:
+                break
+            for i in range(n):
+                byte = self.chunk[i]
+                if self.have == 0 and byte != 0xa5:
+                    continue # Look for the start of a frame
+                self.frame[self.have] = byte
+                self.have += 1
+                if self.have == 6:
+                    self.have = 0
+                    frame = self.frame
+                    if frame[5] == frame[1] ^ frame[2] ^ frame[3] ^ frame[4]:
+                        latest = (frame[1] << 24) | (frame[2] << 16) | (frame[3] << 8) | frame[4]
+                        self.received += 1
+                    else:
+                        self.rejected += 1
+            waiting = self.port.any()
+        return latest
+
+    def track(self, error_ms):
+        self.error_ms = error_ms
+        if abs(error_ms) > self.max_error_ms:
+            self.max_error_ms = abs(error_ms)
+
+
+class RPMidi:
+    def __init__(self, pins=(0, 3, 6, 11, 15, 21, 22), leds=True, led_hz=30, led_thread=False, use_lightsleep=False):
+        # pins are the GPIOs for tone generators 0, 1, 2 and so on (up to 16).
+        # leds=False leaves the indicator LEDs alone entirely. Otherwise they are refreshed led_hz times a
+        # second from the channel state, between score events or (led_thread=True) on the second core.
+        # use_lightsleep=True lets silent stretches use machine.lightsleep, which stops the PWM clocks.
         # Initialize Attributes
         self.is_file = False
         self.is_mem = False
@@ -58,28 +420,97 @@ class RPMidi:
         
         self.length = 0
         
-        # Configure Channels
-        self.channels = {
-            0x90: PWM(Pin(0)),
-            0x91: PWM(Pin(3)),
-            0x92: PWM(Pin(6)),
-            0x93: PWM(Pin(11)),
-            0x94: PWM(Pin(15)),
-            0x95: PWM(Pin(21)),
-            0x96: PWM(Pin(22))
-        }
-
-        self.channel_leds = {
-            0x90: PWM(Pin(26)),  # PWM_A[5] Green LED w/ 15 Ohm Resistor
-            0x91: PWM(Pin(21)),  # PWM_B[2] Yellow LED w/ 47 Ohm Resistor
-            0x92: PWM(Pin(20)),  # PWM_A[2] Blue LED w/ 15 Ohm Resistor
-            0x93: PWM(Pin(18)),  # PWM_B[0] RED LED w/ 47 Ohm Resistor
-            0x94: PWM(Pin(17)),  # PWM_B[0] RED LED w/ 47 Ohm Resistor
-            0x95: PWM(Pin(25)),
-            0x96: PWM(Pin(26))
-        }
+        # Configure Channels, keyed by their play opcode
+        self.channels = {}
+        for i in range(len(pins)):
+            self.channels[0x90 + i] = PWM(Pin(pins[i]))
+
+        self.channel_leds = {}
+        if leds:
+            self.channel_leds = {
+                0x90: PWM(Pin(26)),  # PWM_A[5] Green LED w/ 15 Ohm Resistor
+                0x91: PWM(Pin(21)),  # PWM_B[2] Yellow LED w/ 47 Ohm Resistor
+                0x92: PWM(Pin(20)),  # PWM_A[2] Blue LED w/ 15 Ohm Resistor
+                0x93: PWM(Pin(18)),  # PWM_B[0] RED LED w/ 47 Ohm Resistor
+                0x94: PWM(Pin(17)),  # PWM_B[0] RED LED w/ 47 Ohm Resistor
+                0x95: PWM(Pin(25)),
+                0x96: PWM(Pin(26))
+            }
+
+        # Shared per-channel state: what each tone generator is playing. The audio path only writes
+        # here, the LED refresh reads it and redraws whatever changed since the last refresh.
+        self.channel_freq = [0] * 16
+        self.channel_duty = [0] * 16
+        self._led_freq = [0] * 16
+        self._led_duty = [-1] * 16 # Forces the first refresh to draw every LED
+        self.led_period_ms = 1000 // led_hz
+        self._led_running = False
+        
+        # Note -> PWM frequency and velocity -> duty_u16 lookups, so playback needs no float math.
+        # Velocity 127 is the old fixed 50% duty.
+        self._note_freq = [round(self._pitch(n)) for n in range(128)]
+        self._velocity_duty = [self._duty_cycle(50 * v / 127) for v in range(128)]
+
+        # Note events sharing a timestamp, decoded into register values before any are written
+        self._batch_len = 0
+        self._batch_slot = [0] * 32
+        self._batch_pwm = [None] * 32
+        self._batch_freq = [0] * 32 # 0 mutes the voice
+        self._batch_duty = [0] * 32
+
+        # chord_spread_us is the longest a chord took to write out, chord_decode_us the longest from
+        # starting to decode it to the last write (what one-at-a-time playback would spread it over)
+        self.stats = {"chords": 0, "chord_spread_us": 0, "chord_decode_us": 0}
+
+        # Waits sleep until spin_ms before the deadline and busy-wait the rest. sleep_ms and spin_ms
+        # add up where the time went.
+        self.use_lightsleep = use_lightsleep
+        self.spin_ms = 1
+        self.stats["sleep_ms"] = 0
+        self.stats["spin_ms"] = 0
+        self._sleep_us = 0
+        self._spin_us = 0
+
+        self._byte = bytearray(1) # File reads land here, so reading a byte doesn't allocate
+
+        # Envelope curve (levels out of 256, see set_envelope) and per-channel envelope state
+        self.envelope = None
+        self.envelope_step_ms = 10
+        self._env_step = [0] * 16
+        self._env_duty = [0] * 16
+
+        # Which output each tone generator is sounding on, and what it's playing. Normally that's the
+        # generator's own channel; with set_arpeggio generators can share outputs (see _assign_output).
+        self.arpeggio_ms = 0
+        self._voice_output = [-1] * 16
+        self._voice_freq = [0] * 16
+        self._voice_duty = [0] * 16
+        self._output_voices = [0] * 16 # Bitmask of generators held on each output
+        self._output_count = [0] * 16
+        self._output_current = [-1] * 16 # Generator each output is sounding right now
+
+        # Deadline queue for timed events the sequencer runs between score events. One slot per tone
+        # generator (envelope steps) plus LED_SLOT, STREAM_SLOT and ARP_SLOT, holding a ticks_ms deadline or None.
+        self._timers = [None] * 20
+        self._timer_handlers = [self._envelope_step] * 16 + [self._refresh_leds, self._pump_stream, self._arpeggio_step, self._sync_step]
+
+        # Multi-board sync (see play_song)
+        self.sync = None
+        self._song_start = 0
+
+        self.is_stream = False
+        self.stream = None
+        self.stream_latency_ms = 50
+        self.stream_poll_ms = 5
+        self._clock = utime.ticks_ms()
         
         self.stop_all()
+        self.calibrate_spin()
+
+        if self.channel_leds and led_thread:
+            import _thread
+            self._led_running = True
+            _thread.start_new_thread(self._led_loop, ())
         
     def _pitch(self, freq):
         return (2**((freq-69)/12))*440
@@ -87,70 +518,246 @@ class RPMidi:
     def _duty_cycle(self, percent):
         return round((percent/100)*65535)
 
-    def play_note(self, note, channel, duty):
-        led.toggle()
-        self.channels[channel].freq(round(self._pitch(note)))
-        self.channels[channel].duty_u16(self._duty_cycle(duty))
+    def set_envelope(self, attack_ms=0, decay_ms=0, sustain=100, step_ms=10):
+        # Precompute an attack/decay curve as levels out of 256. Each step is applied to the
+        # note's velocity duty by the sequencer every step_ms, so playback stays integer-only.
+        curve = []
+        attack = attack_ms // step_ms
+        decay = decay_ms // step_ms
+        for i in range(1, attack + 1):
+            curve.append(256 * i // attack)
+        if not curve:
+            curve.append(256)
+        floor = 256 * sustain // 100
+        for i in range(1, decay + 1):
+            curve.append(256 - (256 - floor) * i // decay)
+
+        self.envelope_step_ms = step_ms
+        if len(curve) > 1:
+            self.envelope = curve
+        else:
+            self.envelope = None # Flat envelope, nothing to schedule
+
+    def _envelope_step(self, slot, deadline):
+        step = self._env_step[slot] + 1
+        self._env_step[slot] = step
+        duty = (self._env_duty[slot] * self.envelope[step]) >> 8
+        self._voice_duty[slot] = duty
+        output = self._voice_output[slot]
+        if output >= 0 and self._output_current[output] == slot:
+            self.channels[0x90 + output].duty_u16(duty)
+            self.channel_duty[output] = duty
+        if step + 1 < len(self.envelope):
+            self._timers[slot] = utime.ticks_add(deadline, self.envelope_step_ms)
 
-        self.channel_leds[channel].freq(round(self._pitch(note))) # This is incase the LED is not on the same Slice, freq must be same or collision will occur
-        self.channel_leds[channel].duty_u16(self._duty_cycle(duty/16))
+    def _refresh_leds(self, slot, deadline):
+        # Mirror the channel state onto the LEDs, touching only the ones that changed
+        changed = False
+        for channel in self.channel_leds:
+            i = channel - 0x90
+            duty = self.channel_duty[i] >> 4
+            if duty and self.channel_freq[i] != self._led_freq[i]:
+                self._led_freq[i] = self.channel_freq[i]
+                self.channel_leds[channel].freq(self.channel_freq[i]) # This is incase the LED is not on the same Slice, freq must be same or collision will occur
+            if duty != self._led_duty[i]:
+                self._led_duty[i] = duty
+                self.channel_leds[channel].duty_u16(duty)
+                changed = True
+        if changed:
+            led.toggle()
+        if self.channel_leds and not self._led_running:
+            self._timers[LED_SLOT] = utime.ticks_add(deadline, self.led_period_ms)
+
+    def _led_loop(self):
+        # Runs on the second core when led_thread=True
+        while self._led_running:
+            self._refresh_leds(LED_SLOT, utime.ticks_ms())
+            utime.sleep_ms(self.led_period_ms)
+
+    def stop_leds(self):
+        self._led_running = False
+        self._timers[LED_SLOT] = None
+        for channel in self.channel_leds.values():
+            channel.duty_u16(0)
+        for i in range(16):
+            self._led_duty[i] = 0
+
+    def _note_duty(self, slot, duty):
+        # Starting duty for a note with peak duty, setting up its envelope if there is one
+        if self.envelope is not None:
+            self._env_duty[slot] = duty
+            self._env_step[slot] = 0
+            duty = (duty * self.envelope[0]) >> 8
+            self._timers[slot] = utime.ticks_add(utime.ticks_ms(), self.envelope_step_ms)
+        self._voice_duty[slot] = duty
+        return duty
+
+    def set_arpeggio(self, hz=50):
+        # Polyphony expansion. With hz > 0, notes on tone generators without a pin of their own borrow
+        # the least busy output, and outputs holding several notes cycle through them hz times a second
+        # (a chiptune arpeggio). 0 turns it off.
+        self.stop_all()
+        self.arpeggio_ms = 0
+        if hz:
+            self.arpeggio_ms = max(1, 1000 // hz)
+
+    def _assign_output(self, slot):
+        output = self._voice_output[slot]
+        if output >= 0:
+            return output # Retriggered while still held
+        if 0x90 + slot in self.channels:
+            output = slot
+        else:
+            for i in range(len(self.channels)):
+                if output < 0 or self._output_count[i] < self._output_count[output]:
+                    output = i
+        self._voice_output[slot] = output
+        self._output_voices[output] |= 1 << slot
+        self._output_count[output] += 1
+        return output
+
+    def _release_output(self, slot):
+        output = self._voice_output[slot]
+        if output >= 0:
+            self._voice_output[slot] = -1
+            self._output_voices[output] &= ~(1 << slot)
+            self._output_count[output] -= 1
+            if self._output_current[output] == slot:
+                self._output_current[output] = self._next_voice(output, slot)
+        return output
+
+    def _next_voice(self, output, slot):
+        # Next generator held on output after slot, wrapping around. -1 if there are none.
+        voices = self._output_voices[output]
+        for i in range(1, 17):
+            v = (slot + i) & 0x0f
+            if voices & (1 << v):
+                return v
+        return -1
+
+    def _arpeggio_step(self, slot, deadline):
+        # Move every shared output on to its next held note
+        for output in range(len(self.channels)):
+            if self._output_count[output] > 1:
+                v = self._next_voice(output, self._output_current[output])
+                self._output_current[output] = v
+                pwm = self.channels[0x90 + output]
+                pwm.freq(self._voice_freq[v])
+                pwm.duty_u16(self._voice_duty[v])
+                self.channel_freq[output] = self._voice_freq[v]
+                self.channel_duty[output] = self._voice_duty[v]
+        self._timers[ARP_SLOT] = utime.ticks_add(deadline, self.arpeggio_ms)
+
+    def play_note(self, note, channel, velocity=127, duty=None):
+        # Start a note on the tone generator for play opcode channel (0x9t), the same way a score event would.
+        # velocity is a MIDI velocity, clamped to 0-127. duty is a duty cycle percentage to use instead, which
+        # is what the third argument was before velocity support.
+        if duty is None:
+            duty = self._velocity_duty[min(127, max(0, velocity))]
+        else:
+            duty = self._duty_cycle(min(100, max(0, duty)))
+        slot = channel & 0x0f
+        n = 0
+        if self.arpeggio_ms:
+            self._voice_freq[slot] = self._note_freq[note]
+            self._note_duty(slot, duty)
+            output = self._assign_output(slot)
+            self._output_current[output] = slot
+            n = self._batch_output(0, output)
+            if self._timers[ARP_SLOT] is None:
+                self._timers[ARP_SLOT] = utime.ticks_add(utime.ticks_ms(), self.arpeggio_ms)
+        elif channel in self.channels:
+            self._voice_output[slot] = slot
+            self._output_current[slot] = slot
+            self._batch_slot[0] = slot
+            self._batch_pwm[0] = self.channels[channel]
+            self._batch_freq[0] = self._note_freq[note]
+            self._batch_duty[0] = self._note_duty(slot, duty)
+            n = 1
+        self._batch_len = n
+        self._apply_batch(utime.ticks_us())
 
     def stop_channel(self, channel):
+        # Stop the note on the tone generator for stop opcode channel (0x8t)
         self.debug("stopping channel %s" % (hex(channel)))
-        #TODO: Add Check
-        # Grab Channel By Equivalent Play Opcode
-        self.channels[channel + 0x10].duty_u16(0)
-        self.channel_leds[channel + 0x10].duty_u16(0)
+        slot = channel & 0x0f
+        self._timers[slot] = None
+        n = 0
+        if self.arpeggio_ms:
+            output = self._release_output(slot)
+            if output >= 0:
+                n = self._batch_output(0, output)
+        elif channel + 0x10 in self.channels:
+            self._voice_output[slot] = -1
+            self._batch_slot[0] = slot
+            self._batch_pwm[0] = self.channels[channel + 0x10]
+            self._batch_freq[0] = 0
+            n = 1
+        self._batch_len = n
+        self._apply_batch(utime.ticks_us())
 
 
     def stop_all(self):
         self.debug("stopping all")
+        for slot in range(16):
+            self._timers[slot] = None
+            self.channel_duty[slot] = 0
+            self._voice_output[slot] = -1
+            self._output_voices[slot] = 0
+            self._output_count[slot] = 0
+            self._output_current[slot] = -1
         for channel in self.channels.values():
             channel.duty_u16(0)
-        for channel in self.channel_leds.values():
-            channel.duty_u16(0)
-
-    def _opcodes(self):
-        return [0x90, 0x91, 0x92, 0x93, 0x94, 0x95, 0x96, 0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x86, 0xf0, 0xe0]
-    
-    def _play_note_opcodes(self):
-        return [0x90, 0x91, 0x92, 0x93, 0x94, 0x95, 0x96]
+        self._refresh_leds(LED_SLOT, utime.ticks_ms())
+        self._timers[LED_SLOT] = None
+        self._timers[ARP_SLOT] = None
 
-    def _stop_note_opcodes(self):
-        return [0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x86]
-    
-    def _end_song_opcodes(self):
-        return [0xf0, 0xe0]
-    
-    
     def read_byte(self, music, index):
         if self.is_file:
-            return int.from_bytes(music.read(1), "big")
+            music.readinto(self._byte)
+            return self._byte[0]
         elif self.is_mem:
             return music[index]
+        elif self.is_stream:
+            if not music.count:
+                music.underruns += 1
+                self.debug("stream underrun")
+                self._prebuffer(music)
+            return music.get()
         
     def check_oo_range(self, music, index):
         if self.is_file:
             return index >= self.length # We probably shouldn't be relying on this for a bad for loop array
         elif self.is_mem:
-            index >= len(music)
+            return index >= len(music)
+        return False # Streams end with an end opcode
 
     def adjust_index(self, music, index):
         if self.is_file:
             music.seek(-1, 1)
+        elif self.is_stream:
+            music.unget()
         #elif self.is_mem:
            # print
             # for now do nothing.
+    def rewind(self, music, loop_start, loop_cache):
+        # Go back to the loop start. Returns the (possibly swapped) song data and the new index.
+        if self.is_file:
+            size = self.length - loop_start
+            music.seek(loop_start)
+            if size <= loop_cache:
+                # Loop body fits in RAM, so play every further pass from memory with no more file I/O
+                self.debug("caching %d byte loop body" % (size))
+                music = music.read(size)
+                self.is_file = False
+                self.is_mem = True
+                return music, 0, 0
+        return music, loop_start, loop_start
+
     def debug(self, statement):
         if self.is_debug:
             print(statement)
             
-    def print_pointer(self, music, index):
-        if self.is_file:
-            self.debug("File pointer was at: %s" % (music.tell()))
-        elif self.is_mem:
-            self.debug("Index was at: %d" % (index))
-
     def seek_size(self, f):
         pos = f.tell()
         f.seek(0, 2) # 2 means relative to file's end
@@ -159,137 +766,429 @@ class RPMidi:
         return size
     
     def delay(self, milliseconds):
-        start = utime.ticks_ms();
-        
-        while utime.ticks_diff(utime.ticks_ms(), start) < milliseconds:
+        self.wait_until(utime.ticks_add(utime.ticks_ms(), milliseconds))
+
+    def wait_until(self, deadline):
+        # Run any timed events (envelope steps) falling due before the deadline, then wait it out
+        while True:
+            slot = -1
+            nearest = deadline
+            for i in range(len(self._timers)):
+                t = self._timers[i]
+                if t is not None and utime.ticks_diff(t, nearest) < 0:
+                    slot = i
+                    nearest = t
+            if slot < 0:
+                break
+            self._timers[slot] = None
+            self._sleep_until(nearest)
+            self._timer_handlers[slot](slot, nearest)
+        self._sleep_until(deadline)
+
+    def _sleep_until(self, deadline):
+        start = utime.ticks_us()
+        remaining = utime.ticks_diff(deadline, utime.ticks_ms()) - self.spin_ms
+        if remaining > 0:
+            if self.use_lightsleep and not self.channel_leds and not self.is_stream and not any(self.channel_duty):
+                lightsleep(remaining) # Nothing is sounding, so it's safe to stop the clocks
+            else:
+                utime.sleep_ms(remaining)
+        spin = utime.ticks_us()
+        while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
             pass
-    
-    def is_opcode(self, byte):
-        if byte in self._opcodes():
-            return True
-        elif self.is_delay(byte): # Delay Command
-            return True
-        else:
-            return False
-        
-    def is_delay(self, byte):
-        # If any bit of the most significant hex is 1, this can't be a delay (if our ordering logic is right)
-        return not (self.get_normalized_bit(byte, 7) or self.get_normalized_bit(byte, 6) or self.get_normalized_bit(byte, 5) or self.get_normalized_bit(byte, 4))
+        self._sleep_us += utime.ticks_diff(spin, start)
+        self._spin_us += utime.ticks_diff(utime.ticks_us(), spin)
+        # Carry whole milliseconds into stats so the totals stay small ints however long songs play
+        if self._sleep_us >= 1000:
+            self.stats["sleep_ms"] += self._sleep_us // 1000
+            self._sleep_us %= 1000
+        if self._spin_us >= 1000:
+            self.stats["spin_ms"] += self._spin_us // 1000
+            self._spin_us %= 1000
+
+    def calibrate_spin(self, samples=8):
+        # Spin for the worst sleep_ms(1) overshoot seen, plus the ms tick the sleep may start partway through
+        worst = 0
+        for i in range(samples):
+            start = utime.ticks_us()
+            utime.sleep_ms(1)
+            worst = max(worst, utime.ticks_diff(utime.ticks_us(), start) - 1000)
+        self.spin_ms = worst // 1000 + 1
+        self.debug("spinning for the last %d ms of each wait" % (self.spin_ms))
     
     def delay_inaccurate(self, milliseconds):
-        now = utime.time() * 1000
-       # print('start time in milliseconds %f' % now)
-        
-        start = now
-        end = now + milliseconds
-        #print('end time in milliseconds %f' % end)
-
-        while now < end:
-            #print('current time in milliseconds %f' % now)
-            now = utime.time() * 1000
-
-    # https://realpython.com/python-bitwise-operators/#getting-a-bit
-    def get_normalized_bit(self, value, bit_index):
-        normalized_bit = (value >> bit_index) & 1
-        #self.debug("value of most significant bit: %d" % normalized_bit)
-        return normalized_bit
-
-    def play_song(self, music):
-
-        done = False
-        tmp = []
-        index = 0
-        isReading = False
-        opcode = 0x00
-        
+        # Plain sleep, for waits where a millisecond or two of overshoot doesn't matter
+        utime.sleep_ms(milliseconds)
+
+    def read_header(self, music):
+        # miditones may write a 'Pt' header: 'P', 't', header length, flags 1, flags 2, tone generators.
+        # Returns the index of the first event and whether note-ons carry a velocity byte.
+        if not self.check_oo_range(music, 3) and self.read_byte(music, 0) == 0x50 and self.read_byte(music, 1) == 0x74:
+            length = self.read_byte(music, 2)
+            flags = self.read_byte(music, 3)
+            if self.is_file:
+                music.seek(length)
+            return length, (flags & 0x80) != 0
+        if self.is_file:
+            music.seek(0)
+        return 0, False
+
+    def play_song(self, music, loops=None, loop_start=None, loop_cache=1024, velocity=None, info=None, sync=None, realtime=False, cache=None):
+        # music may be a list, bytes/bytearray or a file opened in binary mode.
+        # loops is how many times 0xe0 restarts the song (None loops forever), and loop_start is
+        # the byte offset restarts jump to, so intros are not replayed. File loop bodies up to
+        # loop_cache bytes are kept in RAM after the first pass.
+        # velocity says whether note-ons carry a velocity byte (miditones -v). None reads it from the header.
+        # The song is validated before anything plays unless info (from validate()) is passed in.
+        # sync is a SyncLeader to share this board's song clock, or a SyncFollower to start on the leader's
+        # clock and keep event deadlines lined up with it.
+        # realtime=True collects garbage before the first note, keeps the collector off until the song ends
+        # and raises AssertionError if any event allocates.
+        # cache is a SongCache. Songs played before are looked up by their hash instead of being validated.
+
         self.stop_all() # Silence any existing music
+        
+        key = None
+        if info is None and cache is not None:
+            key = cache.key(music, velocity, loop_start)
+            info = cache.get(key)
+        if info is None:
+            info = self.validate(music, velocity, loop_start)
+            if key is not None:
+                cache.put(key, info)
+        else:
+            self.set_source(music)
+        if loop_start is None:
+            loop_start = info.start
+        if self.is_file:
+            music.seek(info.start)
         utime.sleep(1)
+
+        self._clock = utime.ticks_ms()
+        if sync is not None:
+            self._start_sync(sync)
+        try:
+            self._play(music, info.start, info.velocity, loops, loop_start, loop_cache, realtime)
+        finally:
+            self._timers[SYNC_SLOT] = None
+            self.sync = None
+
+    def _start_sync(self, sync):
+        self.sync = sync
+        if sync.leader:
+            self._song_start = self._clock
+            sync.send(0)
+            self._timers[SYNC_SLOT] = utime.ticks_add(self._clock, sync.period_ms)
+            return
+
+        # Wait for the leader's clock, then start our song where it says it is
+        song_ms = sync.poll()
+        while song_ms < 0:
+            self.wait_until(utime.ticks_add(utime.ticks_ms(), sync.poll_ms))
+            song_ms = sync.poll()
+        self._clock = utime.ticks_add(utime.ticks_ms(), -(song_ms + sync.latency_ms))
+        self._song_start = self._clock
+        sync.max_error_ms = 0
+        sync.next_ms = utime.ticks_add(utime.ticks_ms(), sync.period_ms)
+        self._timers[SYNC_SLOT] = utime.ticks_add(sync.next_ms, -sync.early_ms)
+
+    def _sync_step(self, slot, deadline):
+        sync = self.sync
+        if sync.leader:
+            sync.send(utime.ticks_diff(utime.ticks_ms(), self._song_start))
+            self._timers[SYNC_SLOT] = utime.ticks_add(deadline, sync.period_ms)
+            return
+
+        now = utime.ticks_ms()
+        song_ms = sync.poll()
+        if song_ms >= 0:
+            # Positive lag means we're behind the leader, so pull our deadlines earlier. Only a quarter of
+            # the lag is corrected per frame (at least 1ms) so one late frame can't throw the timing off.
+            lag = song_ms + sync.latency_ms - utime.ticks_diff(utime.ticks_ms(), self._song_start)
+            sync.track(lag)
+            step = 0
+            if lag > 0:
+                step = max(1, lag >> 2)
+            elif lag < 0:
+                step = min(-1, -((-lag) >> 2))
+            self._song_start = utime.ticks_add(self._song_start, -step)
+            self._clock = utime.ticks_add(self._clock, -step)
+            sync.next_ms = utime.ticks_add(now, sync.period_ms)
+        elif utime.ticks_diff(now, sync.next_ms) >= sync.period_ms >> 1:
+            # Half a period late, so this one was lost. Wait for the one after.
+            sync.missed += 1
+            sync.next_ms = utime.ticks_add(sync.next_ms, sync.period_ms)
+
+        # Only poll around when the next frame is due, so the waits in between can sleep
+        wake = utime.ticks_add(sync.next_ms, -sync.early_ms)
+        if utime.ticks_diff(wake, now) <= 0:
+            wake = utime.ticks_add(now, sync.poll_ms)
+        self._timers[SYNC_SLOT] = wake
+
+    def set_source(self, music):
+        self.is_file = False
+        self.is_mem = False
+        self.is_stream = False
             
-        if type(music) == io.FileIO:
+        if hasattr(music, "read"):
             self.is_file = True
             self.length = self.seek_size(music)
+            music.seek(0)
             
-        elif type(music) == list:
+        else:
             self.is_mem = True
-        
-        while not done:
+
+    def validate(self, music, velocity=None, loop_start=None):
+        # One linear pass over a song before it plays. Raises ScoreError for truncated events, unknown
+        # opcodes, out of range notes, a missing end marker or a loop_start that isn't on an event.
+        # Returns a SongInfo, which play_song(info=...) accepts to skip validating again.
+        self.set_source(music)
+        info = SongInfo()
+        info.start, info.velocity = self.read_header(music)
+        if velocity is not None:
+            info.velocity = velocity
+
+        index = info.start
+        sounding = 0
+        voices = 0
+        found_loop_start = loop_start is None
+        while True:
             if self.check_oo_range(music, index):
-                self.debug("out of range while reading opcode")
-                done = True
+                raise ScoreError("missing end marker", index)
+            if index == loop_start:
+                found_loop_start = True
+            opcode = self.read_byte(music, index)
+            kind = opcode & 0xf0
+            if opcode == 0xf0 or opcode == 0xe0:
+                info.events += 1
+                info.loops = opcode == 0xe0
                 break
+            elif kind == 0x90:
+                size = 2
+                if info.velocity:
+                    size = 3
+            elif kind == 0x80:
+                size = 1
+            elif kind == 0xc0: # Instrument change (miditones -i)
+                size = 2
+            elif opcode < 0x80:
+                size = 2
             else:
-                # Read opcode
-                opcode_byte = self.read_byte(music, index)
-                self.debug(opcode_byte)
-                if self.is_opcode(opcode_byte):
-                    opcode = opcode_byte
-                    
-                    # # Scan for timing data
-                    # isReading = True
-                    # tmp = []
-                    # tmp_index = 1
-                    
-                    # # Read next bytes for timing info
-                    # while isReading: 
-                    #     if self.check_oo_range(music, (index + tmp_index)):
-                    #         self.debug("We are done!")
-                    #         done = True
-                    #         break
-                    #     else:
-                    #         tmp_byte = self.read_byte(music, index + tmp_index)
-                    #         if not self.is_opcode(tmp_byte): #Process delay as a separate command
-                    #             tmp.append(tmp_byte)
-                    #             tmp_index += 1
-                    #             self.debug("reading...got num %s" % hex(tmp_byte))
-                    #         else:
-                    #             self.debug("Last Read was opcode %s Going back..." % hex(tmp_byte))
-                    #             self.adjust_index(music, index)
-                    #             isReading = False
-                    
-                    # Execute instruction
-                    self.debug("About to execute %s" % opcode);
-                    if opcode in self._play_note_opcodes():
-                        # Play voice and goto next instruction or play and wait for x milliseconds
-                        if opcode >= 0x90 and opcode <= 0x96:
-                            self.play_note(self.read_byte(music, index + 1), opcode, 50)
-                            index += 2
-#                        else:
-#                            self.debug("expecting at least one entry in tmp, got nothing")
-#                            self.debug("Next byte would have been %s" % (hex(self.read_byte(music, index + 1))))
-#                            self.print_pointer(music, index)
-#                            done = True
-#                            self.stop_all()
-#                            break
-#                        index += 1
-                        
-                    elif opcode in self._stop_note_opcodes():
-                        # Mute voice or mute and wait for x milliseconds
-                        if opcode >= 0x80 and opcode <= 0x8E:
-                            self.stop_channel(opcode) 
-                   #     if len(tmp) >= 2:
-                    #        delay = ((tmp[0]*256)+(tmp[1]))
-                    #        self.debug("sleeping for %d ms" % (delay))
-                    #        self.delay(delay)
-                        index += 1
-                        
-                    elif opcode in self._end_song_opcodes():
-                        # End or loop the song
-                        if opcode == 0xf0: # Song is over, stop playing.
-                            print("song is over")
-                            done = True
-                            break
-                        else:
-                            print("Loop Song!")
-                            done = False
-                            index = 0 # Song is looping, go back to beginning of song.
-                    elif self.is_delay(opcode): # Delay Command
-                        self.debug("Delay!")
-                        delay = (opcode*256)+(self.read_byte(music, index + 1))
-                        self.debug("sleeping for %d ms" % (delay))
-                        self.delay(delay)
-                                #utime.sleep_ms(delay)
-                        index += 2
-                    else:
-                        print("Byte is busted %s" % hex(opcode))
+                raise ScoreError("unknown opcode 0x%02x" % opcode, index)
+            if self.check_oo_range(music, index + size - 1):
+                raise ScoreError("truncated event 0x%02x" % opcode, index)
+
+            bit = 1 << (opcode & 0x0f)
+            if kind == 0x90:
+                if self.read_byte(music, index + 1) > 127:
+                    raise ScoreError("note out of range", index + 1)
+                if info.velocity and self.read_byte(music, index + 2) > 127:
+                    raise ScoreError("velocity out of range", index + 2)
+                info.notes += 1
+                info.channels |= bit
+                if not sounding & bit:
+                    sounding |= bit
+                    voices += 1
+                    info.max_voices = max(info.max_voices, voices)
+            elif kind == 0x80:
+                if sounding & bit:
+                    sounding &= ~bit
+                    voices -= 1
+            elif kind == 0xc0:
+                self.read_byte(music, index + 1)
+            else:
+                info.duration_ms += (opcode << 8) | self.read_byte(music, index + 1)
+            info.events += 1
+            index += size
+
+        if not found_loop_start:
+            raise ScoreError("loop start is not at an event", loop_start)
+        info.length = index + 1
+        return info
+
+    def _decode_batch(self, music, index, opcode, has_velocity):
+        # Decode the run of note on/off events starting at index into the batch arrays.
+        # Returns the index of the first event after the run.
+        n = 0
+        while True:
+            if opcode & 0x10: # 0x9t, note on
+                note = self.read_byte(music, index + 1)
+                velocity = 127
+                if has_velocity:
+                    velocity = self.read_byte(music, index + 2)
+                    index += 3
+                else:
+                    index += 2
+                slot = opcode & 0x0f
+                if self.arpeggio_ms:
+                    self._voice_freq[slot] = self._note_freq[note]
+                    self._note_duty(slot, self._velocity_duty[velocity])
+                    output = self._assign_output(slot)
+                    self._output_current[output] = slot # The new note sounds straight away
+                    n = self._batch_output(n, output)
+                elif opcode in self.channels:
+                    self._voice_output[slot] = slot
+                    self._output_current[slot] = slot
+                    self._batch_slot[n] = slot
+                    self._batch_pwm[n] = self.channels[opcode]
+                    self._batch_freq[n] = self._note_freq[note]
+                    self._batch_duty[n] = self._note_duty(slot, self._velocity_duty[velocity])
+                    n += 1
+            else: # 0x8t, note off
+                index += 1
+                slot = opcode & 0x0f
+                self._timers[slot] = None
+                if self.arpeggio_ms:
+                    output = self._release_output(slot)
+                    if output >= 0:
+                        n = self._batch_output(n, output)
+                elif opcode + 0x10 in self.channels:
+                    self._voice_output[slot] = -1
+                    self._batch_slot[n] = slot
+                    self._batch_pwm[n] = self.channels[opcode + 0x10]
+                    self._batch_freq[n] = 0
+                    n += 1
+
+            if n == len(self._batch_pwm) or (self.is_stream and not music.count):
+                break # Batch full, or nothing to look ahead at without waiting
+            opcode = self.read_byte(music, index)
+            if (opcode & 0xe0) != 0x80:
+                self.adjust_index(music, index) # Not part of this batch, leave it for the main loop
+                break
+        self._batch_len = n
+        return index
+
+    def _batch_output(self, n, output):
+        # Add whatever a shared output should now be sounding to the batch
+        v = self._output_current[output]
+        self._batch_slot[n] = output
+        self._batch_pwm[n] = self.channels[0x90 + output]
+        self._batch_freq[n] = 0
+        if v >= 0:
+            self._batch_freq[n] = self._voice_freq[v]
+            self._batch_duty[n] = self._voice_duty[v]
+        return n + 1
+
+    def _apply_batch(self, start):
+        # Write out a decoded batch back to back
+        first = utime.ticks_us()
+        for i in range(self._batch_len):
+            slot = self._batch_slot[i]
+            freq = self._batch_freq[i]
+            if freq:
+                self._batch_pwm[i].freq(freq)
+                self._batch_pwm[i].duty_u16(self._batch_duty[i])
+                self.channel_freq[slot] = freq
+                self.channel_duty[slot] = self._batch_duty[i]
+            else:
+                self._batch_pwm[i].duty_u16(0)
+                self.channel_duty[slot] = 0
+        if self._batch_len > 1:
+            last = utime.ticks_us()
+            self.stats["chords"] += 1
+            self.stats["chord_spread_us"] = max(self.stats["chord_spread_us"], utime.ticks_diff(last, first))
+            self.stats["chord_decode_us"] = max(self.stats["chord_decode_us"], utime.ticks_diff(last, start))
+
+    def _pump_stream(self, slot, deadline):
+        self.stream.pump()
+        self._timers[STREAM_SLOT] = utime.ticks_add(utime.ticks_ms(), self.stream_poll_ms)
+
+    def _prebuffer(self, stream):
+        # Wait for data, then hold off for the latency target so host-side jitter is absorbed
+        while not stream.count:
+            self.wait_until(utime.ticks_add(utime.ticks_ms(), self.stream_poll_ms))
+        self._clock = utime.ticks_add(utime.ticks_ms(), self.stream_latency_ms)
+        self.wait_until(self._clock)
+
+    def play_stream(self, source, latency_ms=50, buffer_size=512, midi=False, velocity=False, realtime=False, poll_ms=5):
+        # Play a live stream of opcodes (or raw MIDI with midi=True) from a UART, StdinSource or
+        # anything else with any()/readinto(). latency_ms of input is buffered before playing starts and
+        # after every underrun. Ends on 0xf0 or 0xe0 (MIDI Stop in MIDI mode). realtime is as for play_song.
+        # The source is read every poll_ms, so the CPU can sleep in between. Its receive buffer has to hold
+        # that long's input (a UART's does at MIDI's 31250 baud or 115200), and MIDI note times are rounded
+        # to it. Returns the StreamBuffer for its counters.
+        self.stop_all()
+
+        self.is_file = False
+        self.is_mem = False
+        self.is_stream = True
+        channels = len(self.channels)
+        if self.arpeggio_ms:
+            channels = 16 # Generators without a pin borrow one, so keep them all
+        self.stream = StreamBuffer(source, buffer_size, midi, channels)
+        self.stream_latency_ms = latency_ms
+        self.stream_poll_ms = max(1, poll_ms)
+
+        if isinstance(source, StdinSource):
+            source.open()
+        self._timers[STREAM_SLOT] = utime.ticks_ms()
+        try:
+            self._prebuffer(self.stream)
+            self._play(self.stream, 0, velocity or midi, 0, 0, 0, realtime)
+        finally:
+            self._timers[STREAM_SLOT] = None
+            self.is_stream = False
+            if isinstance(source, StdinSource):
+                source.close() # Ctrl-C works on the REPL again
+        return self.stream
+
+    def _play(self, music, index, has_velocity, loops, loop_start, loop_cache, realtime=False):
+        # Playback loop. Songs have been through validate() so every event is complete and the song
+        # ends in 0xf0 or 0xe0. Live streams can't be checked upfront, hence the ScoreError at the bottom.
+        # With realtime, garbage collection is held off for the whole song and every event is checked to
+        # leave the heap exactly as it found it.
+        loop_count = 0
+
+        if self.channel_leds and not self._led_running:
+            self._timers[LED_SLOT] = self._clock
+        if self.arpeggio_ms:
+            self._timers[ARP_SLOT] = self._clock
+
+        if realtime:
+            gc.collect()
+            gc.disable()
+            heap = mem_alloc()
+        try:
+            while True:
+                opcode = self.read_byte(music, index)
+                kind = opcode & 0xf0
+                if kind == 0x90 or kind == 0x80:
+                    # Play or mute voices. Every note event at this timestamp is decoded first and then
+                    # written out in one burst, so the voices of a chord start together.
+                    start = utime.ticks_us()
+                    index = self._decode_batch(music, index, opcode, has_velocity)
+                    self._apply_batch(start)
+                elif opcode < 0x80: # Delay Command
+                    # Delays are counted on the song clock so per-event overhead doesn't add up as drift
+                    self._clock = utime.ticks_add(self._clock, (opcode << 8) | self.read_byte(music, index + 1))
+                    self.wait_until(self._clock)
+                    index += 2
+                elif opcode == 0xe0 and (loops is None or loop_count < loops):
+                    print("Loop Song!")
+                    loop_count += 1
+                    # Song is looping, go back to the loop start.
+                    music, index, loop_start = self.rewind(music, loop_start, loop_cache)
+                    if realtime:
+                        heap = mem_alloc() # Caching the loop body is a one-off, not per event
+                elif opcode == 0xf0 or opcode == 0xe0: # Song is over (or out of loops), stop playing.
+                    print("song is over")
+                    break
+                elif kind == 0xc0:
+                    self.read_byte(music, index + 1) # Instrument change, PWM only has the one instrument
+                    index += 2
                 else:
-                    index += 1
+                    raise ScoreError("unknown opcode 0x%02x" % opcode, index)
+
+                if realtime:
+                    grown = mem_alloc() - heap
+                    if grown > 0:
+                        raise AssertionError("heap grew by %d bytes before offset %d" % (grown, index))
+        finally:
+            if realtime:
+                gc.enable()
+
+        self._timers[ARP_SLOT] = None
+        if self.channel_leds and not self._led_running:
+            # Nothing services the deadline queue once the song is over, so draw the final state now
+            self._refresh_leds(LED_SLOT, utime.ticks_ms())
+            self._timers[LED_SLOT] = None
@@ -0,0 +1,230 @@
+"""
+rpmidi_sim
+A stand-in for the Pico's machine/utime modules so RPMidi can run on a regular computer with CPython.
+rpmidi.py falls back to this automatically when machine can't be imported.
+
+PWM writes are kept as state on each PWM object, and appended to `log` as (ticks_us, pin, "freq"/"duty", value)
+when it is set to a list. PipeUART gives a UART-like endpoint over OS pipes for driving RPMidi's streaming
+input from another process or thread.
+"""
+
+import dis
+import fcntl
+import gc
+import os
+import struct
+import sys
+import termios
+import time as _time
+
+log = None # Set to a list to record every PWM write
+
+_start = _time.monotonic_ns()
+
+
+# utime
+
+def ticks_ms():
+    return (_time.monotonic_ns() - _start) // 1000000
+
+def ticks_us():
+    return (_time.monotonic_ns() - _start) // 1000
+
+def ticks_diff(a, b):
+    return a - b
+
+def ticks_add(a, b):
+    return a + b
+
+def sleep(seconds):
+    _time.sleep(seconds)
+
+def sleep_ms(milliseconds):
+    _time.sleep(milliseconds / 1000)
+
+def sleep_us(microseconds):
+    _time.sleep(microseconds / 1000000)
+
+def time():
+    return int(_time.time())
+
+
+# gc
+
+# MicroPython allocates on the heap for these instructions, whatever CPython does with freelists and caches
+_ALLOCATING_OPS = ("BUILD_LIST", "BUILD_MAP", "BUILD_SET", "BUILD_STRING", "BUILD_SLICE", "BUILD_CONST_KEY_MAP",
+                   "FORMAT_VALUE", "LIST_APPEND", "LIST_EXTEND", "LIST_TO_TUPLE", "SET_ADD", "SET_UPDATE", "MAP_ADD",
+                   "DICT_UPDATE", "DICT_MERGE", "MAKE_FUNCTION")
+# and for calls to these
+_ALLOCATING_BUILTINS = ("float", "str", "bytes", "bytearray", "list", "tuple", "dict", "set", "hex", "bin", "oct",
+                        "repr", "format", "sorted", "memoryview")
+
+_allocating = {} # code object -> offsets of its allocating instructions
+_allocations = 0 # Allocating instructions run while the collector was off
+
+def _allocating_offsets(code):
+    offsets = set()
+    instructions = list(dis.get_instructions(code))
+    for i in range(len(instructions)):
+        ins = instructions[i]
+        if ins.opname in _ALLOCATING_OPS or (ins.opname == "BUILD_TUPLE" and ins.arg):
+            offsets.add(ins.offset)
+        elif ins.opname in ("LOAD_GLOBAL", "LOAD_NAME") and ins.argval in _ALLOCATING_BUILTINS:
+            offsets.add(ins.offset)
+        elif ins.opname == "BINARY_OP":
+            if ins.argrepr in ("/", "/=", "**", "**="):
+                offsets.add(ins.offset) # Float results
+            else:
+                for operand in instructions[max(0, i - 2):i]:
+                    # String formatting, or arithmetic with a float constant
+                    if operand.opname == "LOAD_CONST" and isinstance(operand.argval, (str, bytes, float)):
+                        offsets.add(ins.offset)
+    return offsets
+
+def _traced(code):
+    filename = code.co_filename
+    return not filename.endswith("rpmidi_sim.py") and not filename.startswith((sys.prefix, sys.base_prefix))
+
+def _trace_instructions(frame, event, arg):
+    global _allocations
+    if event == "opcode":
+        if frame.f_lasti in _allocating[frame.f_code]:
+            _allocations += 1
+    return _trace_instructions
+
+def _trace_calls(frame, event, arg):
+    if gc.isenabled():
+        sys.settrace(None) # Realtime playback is over
+        return None
+    if not _traced(frame.f_code):
+        return None
+    _watch(frame)
+    return _trace_instructions
+
+def _watch(frame):
+    if frame.f_code not in _allocating:
+        _allocating[frame.f_code] = _allocating_offsets(frame.f_code)
+    frame.f_trace_opcodes = True
+    frame.f_trace = _trace_instructions
+
+def mem_alloc():
+    # gc.mem_alloc() stand-in, for checking RPMidi doesn't allocate as it plays. CPython frees objects on the
+    # spot and keeps its own freelists, so rather than trust its heap this counts 16 bytes (a MicroPython heap
+    # block) for every instruction run with the collector off that would allocate on MicroPython: building
+    # lists, tuples, dicts and strings, formatting, float maths and the like. Ints don't count, as MicroPython
+    # keeps them in the pointer. On top of that comes the size of everything the RPMidi objects on the stack
+    # can reach, which catches anything built out of sight of the count and kept.
+    if not gc.isenabled() and sys.gettrace() is not _trace_calls:
+        sys.settrace(_trace_calls)
+        frame = sys._getframe(1)
+        while frame is not None:
+            if _traced(frame.f_code):
+                _watch(frame)
+            frame = frame.f_back
+
+    todo = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename.endswith("rpmidi.py") and "self" in frame.f_locals:
+            todo.append(frame.f_locals["self"])
+        frame = frame.f_back
+    seen = set()
+    total = 16 * _allocations
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or obj is None or obj is True or obj is False:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, int) and -0x40000000 <= obj < 0x40000000:
+            continue
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple, dict, set)):
+            todo.extend(gc.get_referents(obj))
+        elif type(obj).__module__ != "builtins" and hasattr(obj, "__dict__"): # Instances, not modules or classes
+            todo.append(obj.__dict__)
+    return total
+
+
+# machine
+
+class Pin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, pin, mode=None):
+        self.pin = pin
+        self._value = 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def toggle(self):
+        self._value ^= 1
+
+
+def lightsleep(milliseconds):
+    sleep_ms(milliseconds)
+
+
+class PWM:
+    def __init__(self, pin):
+        self.pin = pin.pin
+        self._freq = 0
+        self._duty = 0
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+        if log is not None:
+            log.append((ticks_us(), self.pin, "freq", value))
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        if log is not None:
+            log.append((ticks_us(), self.pin, "duty", value))
+
+
+class PipeUART:
+    # UART-like endpoint (any, readinto, read, write) over a pair of OS pipe file descriptors
+    def __init__(self, read_fd, write_fd):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        os.set_blocking(read_fd, False)
+
+    def any(self):
+        return struct.unpack("i", fcntl.ioctl(self.read_fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buf)
+        try:
+            data = os.read(self.read_fd, nbytes)
+        except BlockingIOError:
+            return 0
+        buf[:len(data)] = data
+        return len(data)
+
+    def read(self, nbytes=1):
+        try:
+            return os.read(self.read_fd, nbytes)
+        except BlockingIOError:
+            return None
+
+    def write(self, data):
+        return os.write(self.write_fd, data)
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+def pipe_pair():
+    # Two connected PipeUART endpoints, e.g. a host and a simulated Pico
+    a_read, b_write = os.pipe()
+    b_read, a_write = os.pipe()
+    return PipeUART(a_read, a_write), PipeUART(b_read, b_write)
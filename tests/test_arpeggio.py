@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rpmidi
+from rpmidi import RPMidi
+
+
+def test_play_note_and_stop_channel_share_outputs():
+    midi = RPMidi(pins=(0, 3), leds=False)
+    midi.set_arpeggio(50)
+    for slot in range(4): # Generators 2 and 3 have no pin of their own
+        midi.play_note(60 + slot, 0x90 + slot)
+    assert midi._output_count[:2] == [2, 2]
+    assert midi._timers[rpmidi.ARP_SLOT] is not None
+
+    midi.stop_channel(0x82)
+    midi.stop_channel(0x83)
+    assert midi._output_count[:2] == [1, 1]
+    assert midi._output_voices[:2] == [1 << 0, 1 << 1]
+
+    midi.stop_channel(0x80)
+    midi.stop_channel(0x81)
+    assert midi.channel_duty[:2] == [0, 0]
+    assert midi._output_current[:2] == [-1, -1]
+
+
+def test_notes_without_a_pin_are_ignored_without_arpeggio():
+    midi = RPMidi(pins=(0, 3), leds=False)
+    midi.play_note(60, 0x95)
+    midi.stop_channel(0x85)
+    assert midi.channel_duty[:2] == [0, 0]
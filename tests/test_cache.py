@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpmidi import RPMidi, SongCache
+
+SONG_A = bytes([0x90, 60, 0, 5, 0x80, 0xf0])
+SONG_B = bytes([0x90, 62, 0, 9, 0x80, 0xf0])
+
+
+def test_lookups_reorder_in_ram_only(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.txt")
+    midi = RPMidi(leds=False)
+    cache = SongCache(path)
+    a = cache.key(SONG_A)
+    b = cache.key(SONG_B)
+    cache.put(a, midi.validate(SONG_A))
+    cache.put(b, midi.validate(SONG_B))
+    saves = []
+    monkeypatch.setattr(cache, "save", lambda: saves.append(1) or SongCache.save(cache))
+
+    assert cache.get(a).duration_ms == 5
+    assert cache.get(b).duration_ms == 9
+    assert cache.hits == 2
+    assert not saves
+    assert cache.dirty
+
+    cache.get(a)
+    cache.flush()
+    assert len(saves) == 1
+    assert not cache.dirty
+    assert SongCache(path).lines[-1].startswith(a)
+
+
+def test_partial_lines_are_skipped(tmp_path):
+    path = str(tmp_path / "cache.txt")
+    midi = RPMidi(leds=False)
+    cache = SongCache(path)
+    a = cache.key(SONG_A)
+    b = cache.key(SONG_B, velocity=True)
+    cache.put(a, midi.validate(SONG_A))
+    cache.put(b, midi.validate(SONG_B))
+    with open(path) as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(text[:text.index(b) + 40]) # Second line cut off part way
+
+    cache = SongCache(path)
+    assert len(cache.lines) == 1
+    assert cache.get(b) is None
+    assert cache.get(a) is not None
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rpmidi
+import rpmidi_sim
+from rpmidi import RPMidi
+
+# An intro note, then a two chord loop body starting at offset 5
+SONG = [0x90, 72, 0, 3, 0x80,
+        0x90, 60, 0x91, 64, 0, 3, 0x80, 0x81, 0x90, 62, 0, 3, 0x80, 0xe0]
+LOOP_START = 5
+
+
+@pytest.fixture(autouse=True)
+def no_lead_in(monkeypatch):
+    monkeypatch.setattr(rpmidi.utime, "sleep", lambda seconds: None)
+
+
+def pwm_writes(music, loop_cache=1024):
+    # The (pin, "freq"/"duty", value) writes from playing music through twice more after the first pass
+    midi = RPMidi(leds=False)
+    rpmidi_sim.log = []
+    try:
+        midi.play_song(music, loops=2, loop_start=LOOP_START, loop_cache=loop_cache)
+        return midi, [(pin, kind, value) for t, pin, kind, value in rpmidi_sim.log]
+    finally:
+        rpmidi_sim.log = None
+
+
+def test_loop_sources_match(tmp_path):
+    path = tmp_path / "song.bin"
+    path.write_bytes(bytes(SONG))
+    midi, expected = pwm_writes(SONG)
+    assert pwm_writes(bytes(SONG))[1] == expected
+    for loop_cache in (0, 1024):
+        with open(path, "rb") as f:
+            assert pwm_writes(f, loop_cache)[1] == expected
+
+    freqs = [value for pin, kind, value in expected if kind == "freq" and value]
+    assert freqs.count(midi._note_freq[72]) == 1 # The intro isn't replayed
+    assert freqs.count(midi._note_freq[60]) == 3
+    assert freqs.count(midi._note_freq[62]) == 3
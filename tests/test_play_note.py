@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpmidi import RPMidi
+
+
+@pytest.mark.parametrize("velocity, expected", [(127, 127), (100, 100), (200, 127), (-5, 0)])
+def test_velocity_is_clamped(velocity, expected):
+    midi = RPMidi(leds=False)
+    midi.play_note(60, 0x90, velocity)
+    assert midi.channel_duty[0] == midi._velocity_duty[expected]
+
+
+@pytest.mark.parametrize("duty, percent", [(50, 50), (25, 25), (150, 100)])
+def test_duty_percentage(duty, percent):
+    midi = RPMidi(leds=False)
+    midi.play_note(60, 0x91, duty=duty)
+    assert midi.channel_duty[1] == midi._duty_cycle(percent)
+    midi.stop_channel(0x81)
+    assert midi.channel_duty[1] == 0
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rpmidi
+from rpmidi import RPMidi
+
+# Two chords, then loop
+SONG = bytes([0x90, 60, 0x91, 64, 0, 5, 0x80, 0x81, 0x90, 62, 0x91, 65, 0, 5, 0x80, 0x81, 0xe0])
+
+
+class LeakyRPMidi(RPMidi):
+    # Keeps a new tuple per chord, which is just the sort of thing realtime mode is there to catch
+    def _apply_batch(self, start):
+        RPMidi._apply_batch(self, start)
+        self.history.append((start, self._batch_len))
+
+
+class FormattingRPMidi(RPMidi):
+    # Builds and drops a debug string per chord, which the heap would keep until the next collect
+    def _apply_batch(self, start):
+        RPMidi._apply_batch(self, start)
+        self.debug("chord at %d" % start)
+
+
+class ListRPMidi(RPMidi):
+    # Checks opcodes against a list literal, rebuilt every time
+    def _apply_batch(self, start):
+        RPMidi._apply_batch(self, start)
+        opcodes = [0x90, 0x91]
+        if self._batch_len in opcodes:
+            pass
+
+
+class FloatRPMidi(RPMidi):
+    # Works out a float per chord
+    def _apply_batch(self, start):
+        RPMidi._apply_batch(self, start)
+        self.last_ms = start / 1000
+
+
+@pytest.fixture(autouse=True)
+def no_lead_in(monkeypatch):
+    monkeypatch.setattr(rpmidi.utime, "sleep", lambda seconds: None)
+
+
+@pytest.mark.parametrize("leds", [False, True])
+def test_realtime_playback_does_not_allocate(leds):
+    midi = RPMidi(leds=leds)
+    midi.set_envelope(attack_ms=2, decay_ms=4, sustain=60, step_ms=1)
+    midi.play_song(SONG, loops=2, realtime=True)
+    chords = midi.stats["chords"]
+    for run in range(4): # Timing differs from run to run, the answer shouldn't
+        midi.play_song(SONG, loops=2, realtime=True)
+    assert midi.stats["chords"] == 5 * chords
+
+
+def test_realtime_playback_from_file_does_not_allocate(tmp_path):
+    path = tmp_path / "song.bin"
+    path.write_bytes(SONG)
+    midi = RPMidi(leds=False)
+    with open(path, "rb") as f:
+        midi.play_song(f, loops=2, loop_cache=0, realtime=True)
+
+
+def test_realtime_playback_catches_allocation():
+    midi = LeakyRPMidi(leds=False)
+    midi.history = []
+    with pytest.raises(AssertionError, match="heap grew"):
+        midi.play_song(SONG, loops=0, realtime=True)
+
+
+@pytest.mark.parametrize("player", [FormattingRPMidi, ListRPMidi, FloatRPMidi])
+def test_realtime_playback_catches_dropped_allocations(player):
+    midi = player(leds=False)
+    with pytest.raises(AssertionError, match="heap grew"):
+        midi.play_song(SONG, loops=0, realtime=True)
@@ -0,0 +1,120 @@
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rpmidi
+import rpmidi_sim
+from rpmidi import RPMidi, StdinSource, StreamBuffer
+
+
+def random_midi(rng, messages):
+    # Note on/off messages on a few channels, often using running status
+    data = bytearray()
+    status = 0
+    for i in range(messages):
+        if rng.random() < 0.05:
+            data.append(0xf8) # Timing clock, ignored
+        new_status = rng.choice((0x80, 0x90)) | rng.randrange(4)
+        if new_status != status or rng.random() < 0.3:
+            status = new_status
+            data.append(status)
+        data.append(rng.randrange(40, 44))
+        data.append(rng.choice((0, 64, 100)))
+    data.append(0xfc)
+    return data
+
+
+def play_through(data, size):
+    # Drain a StreamBuffer fed from a pipe, reading a few bytes at a time like the player does
+    host, pico = rpmidi_sim.pipe_pair()
+    try:
+        host.write(data)
+        stream = StreamBuffer(pico, size=size, midi=True)
+        rng = random.Random(size)
+        out = bytearray()
+        while not out or out[-1] != 0xf0:
+            stream.pump()
+            assert 0 <= stream.count <= len(stream.data)
+            for i in range(min(stream.count, rng.randrange(3))):
+                out.append(stream.get())
+        return out
+    finally:
+        host.close()
+        pico.close()
+
+
+def without_delays(data):
+    # The translated events with the delays between them taken out
+    events = []
+    i = 0
+    while i < len(data):
+        if data[i] < 0x80:
+            i += 2
+        elif data[i] & 0xf0 == 0x90:
+            events.append(bytes(data[i:i + 3]))
+            i += 3
+        else:
+            events.append(bytes(data[i:i + 1]))
+            i += 1
+    return events
+
+
+def test_midi_pump_never_overfills(monkeypatch):
+    # Every pump sees a later time, so events pick up delays and a pending message can complete with the
+    # buffer nearly full
+    clock = [0]
+    def ticks_ms():
+        clock[0] += 1
+        return clock[0]
+    monkeypatch.setattr(rpmidi.utime, "ticks_ms", ticks_ms)
+    rng = random.Random(30)
+    for run in range(40):
+        data = random_midi(rng, 60)
+        expected = without_delays(play_through(data, 4096))
+        for size in range(6, 16):
+            assert without_delays(play_through(data, size)) == expected
+
+
+class PipeStdin:
+    # Enough of sys.stdin for StdinSource: a fileno() to poll and an unbuffered .buffer to read from
+    def __init__(self, fd):
+        self.buffer = io.FileIO(fd, "rb", closefd=False)
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+def test_stdin_chord_arrives_as_one_batch(monkeypatch):
+    monkeypatch.setattr(rpmidi.utime, "sleep", lambda seconds: None)
+    read_fd, write_fd = os.pipe()
+    try:
+        monkeypatch.setattr(sys, "stdin", PipeStdin(read_fd))
+        source = StdinSource()
+        # Note-ons on four channels in one write, then MIDI Stop
+        os.write(write_fd, bytes([0x90, 60, 100, 0x91, 64, 100, 0x92, 67, 100, 0x93, 72, 100, 0xfc]))
+        midi = RPMidi(leds=False)
+        midi.play_stream(source, latency_ms=5, midi=True)
+        assert midi.stats["chords"] == 1
+        assert midi.channel_duty[:4] == [midi._velocity_duty[100]] * 4
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_stream_sleeps_between_polls(monkeypatch):
+    monkeypatch.setattr(rpmidi.utime, "sleep", lambda seconds: None)
+    host, pico = rpmidi_sim.pipe_pair()
+    try:
+        # A note held for 100ms
+        host.write(bytes([0x90, 60, 0, 100, 0x80, 0xf0]))
+        midi = RPMidi(leds=False)
+        midi.spin_ms = 1 # However slow sleep_ms was to calibrate
+        midi.play_stream(pico, latency_ms=5, poll_ms=5)
+        assert midi.stats["sleep_ms"] > 50
+    finally:
+        host.close()
+        pico.close()
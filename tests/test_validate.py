@@ -0,0 +1,64 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpmidi import RPMidi, ScoreError
+
+# miditones header: 'P', 't', header length, flags 1 (0x80 = velocity), flags 2, tone generators
+HEADER = [0x50, 0x74, 6, 0x80, 0, 2]
+
+
+def sources(data):
+    # The same song as a list, bytes and a file
+    return [list(data), bytes(data), io.BytesIO(bytes(data))]
+
+
+@pytest.mark.parametrize("data, loop_start, message, offset", [
+    ([0x90], None, "truncated event 0x90", 0),
+    ([0x90, 60, 0], None, "truncated event 0x00", 2),
+    ([0x90, 60, 0xa0, 0xf0], None, "unknown opcode 0xa0", 2),
+    ([0x90, 60, 0, 5, 0x80], None, "missing end marker", 5),
+    ([0x90, 200, 0xf0], None, "note out of range", 1),
+    (HEADER + [0x90, 60, 200, 0xf0], None, "velocity out of range", 8),
+    ([0x90, 60, 0, 5, 0x80, 0xe0], 1, "loop start is not at an event", 1),
+    ([0x90, 60, 0, 5, 0x80, 0xe0], 9, "loop start is not at an event", 9),
+])
+def test_bad_songs_report_offset(data, loop_start, message, offset):
+    midi = RPMidi(leds=False)
+    for music in sources(data):
+        with pytest.raises(ScoreError, match=message) as error:
+            midi.validate(music, loop_start=loop_start)
+        assert error.value.offset == offset
+
+
+def test_song_info():
+    song = HEADER + [0x90, 60, 100, 0x91, 64, 90, 0, 10, 0x80, 0, 20, 0x81, 0xe0]
+    midi = RPMidi(leds=False)
+    for music in sources(song):
+        info = midi.validate(music, loop_start=12)
+        assert info.start == 6
+        assert info.velocity
+        assert info.length == len(song)
+        assert info.duration_ms == 30
+        assert info.events == 7
+        assert info.notes == 2
+        assert info.max_voices == 2
+        assert info.channels == 0b11
+        assert info.loops
+
+
+def test_velocity_argument_overrides_header():
+    # Without the header flag the velocity is read as a delay, which swallows the end marker
+    song = [0x90, 60, 100, 0, 5, 0xf0]
+    midi = RPMidi(leds=False)
+    with pytest.raises(ScoreError, match="missing end marker"):
+        midi.validate(song)
+    info = midi.validate(song, velocity=True)
+    assert info.velocity
+    assert info.duration_ms == 5
+    assert info.events == 3
+    assert not info.loops
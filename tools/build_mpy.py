@@ -0,0 +1,94 @@
+"""
+build_mpy.py
+Host-side build for RPMidi. Run from the repository root with CPython:
+
+    python tools/build_mpy.py
+
+Writes into build/:
+* songs.py    - songs.py with every song turned into a module-level bytes constant, validated, with its
+                SongInfo available from <song>_info() so the Pico doesn't validate it again
+* rpmidi.mpy  - precompiled rpmidi.py (needs mpy-cross, see --mpy-cross)
+* songs.mpy   - precompiled song data
+* manifest.py - manifest for freezing both modules into a MicroPython firmware build
+
+Copy the .mpy files onto the Pico instead of the .py files so nothing is compiled on boot. When frozen into
+firmware, the song bytes stay in flash and are never copied into the heap.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_songs():
+    # songs.py is plain Python, so the host can import it and ask for each song's data.
+    # rpmidi.py runs on its simulator backend here, which is all validate() needs.
+    sys.path.insert(0, ROOT)
+    from rpmidi import RPMidi
+    from songs import SongData
+
+    midi = RPMidi(leds=False)
+    songs = SongData()
+    names = [name for name in dir(SongData) if not name.startswith("_") and callable(getattr(SongData, name))]
+    result = []
+    for name in sorted(names):
+        data = bytes(getattr(songs, name)())
+        result.append((name, data, midi.validate(data)))
+    return result
+
+
+def write_songs(path, songs):
+    with open(path, "w") as f:
+        f.write("# Generated by tools/build_mpy.py from songs.py - do not edit.\n\n")
+        f.write("from rpmidi import SongInfo\n\n")
+        for name, data, info in songs:
+            fields = ", ".join("%s=%r" % item for item in sorted(vars(info).items()))
+            f.write("_%s = %r\n" % (name.upper(), data))
+            f.write("_%s_INFO = SongInfo(%s)\n\n" % (name.upper(), fields))
+        f.write("class SongData:\n")
+        for name, data, info in songs:
+            f.write("    def %s(self):\n" % name)
+            f.write("        return _%s\n\n" % name.upper())
+            f.write("    def %s_info(self):\n" % name)
+            f.write("        return _%s_INFO\n\n" % name.upper())
+
+
+def write_manifest(path):
+    with open(path, "w") as f:
+        f.write("# Generated by tools/build_mpy.py. Pass to the firmware build with FROZEN_MANIFEST.\n")
+        f.write('module("rpmidi.py", base_path="%s")\n' % ROOT.replace("\\", "/"))
+        f.write('module("songs.py")\n')
+
+
+def cross_compile(mpy_cross, source, output):
+    print("mpy-cross %s -> %s" % (os.path.relpath(source, ROOT), os.path.relpath(output, ROOT)))
+    subprocess.check_call([mpy_cross, "-o", output, source])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build precompiled RPMidi modules and song data.")
+    parser.add_argument("--mpy-cross", default="mpy-cross", help="mpy-cross executable (default: from PATH)")
+    parser.add_argument("--no-mpy", action="store_true", help="only generate build/songs.py and build/manifest.py")
+    parser.add_argument("--out", default=os.path.join(ROOT, "build"), help="output directory (default: build/)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    songs = load_songs()
+    songs_py = os.path.join(args.out, "songs.py")
+    write_songs(songs_py, songs)
+    for name, data, info in songs:
+        print("%s: %d bytes, %d ms, %d events, up to %d voices" % (name, len(data), info.duration_ms, info.events, info.max_voices))
+
+    write_manifest(os.path.join(args.out, "manifest.py"))
+
+    if not args.no_mpy:
+        cross_compile(args.mpy_cross, os.path.join(ROOT, "rpmidi.py"), os.path.join(args.out, "rpmidi.mpy"))
+        cross_compile(args.mpy_cross, songs_py, os.path.join(args.out, "songs.mpy"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+measure_boot.py
+Run on the Pico (e.g. copy it over as main.py) to see how long it takes to get from power-up to the first
+note and how much heap loading RPMidi and the song data needs. Run it once with rpmidi.py/songs.py on the
+board and once with the .mpy files from tools/build_mpy.py to compare.
+"""
+
+import gc
+import utime
+
+gc.collect()
+gc.disable() # Nothing gets freed while measuring, so mem_alloc() growth is the peak transient heap use
+base = gc.mem_alloc()
+start = utime.ticks_ms()
+
+from rpmidi import RPMidi
+from songs import SongData
+
+import_ms = utime.ticks_diff(utime.ticks_ms(), start)
+import_heap = gc.mem_alloc() - base
+
+song = SongData().morning_music()
+load_heap = gc.mem_alloc() - base
+
+gc.enable()
+gc.collect()
+
+
+class FirstNote(Exception):
+    pass
+
+
+class MeasuredRPMidi(RPMidi):
+    # Notes are written out by _apply_batch, so stop as soon as a batch leaves one sounding
+    def _apply_batch(self, start):
+        RPMidi._apply_batch(self, start)
+        if any(self.channel_duty):
+            raise FirstNote()
+
+
+first_note = None
+midi = MeasuredRPMidi()
+try:
+    midi.play_song(song)
+except FirstNote:
+    first_note = utime.ticks_ms() # ticks_ms starts counting at boot
+midi.stop_all()
+if first_note is None:
+    raise RuntimeError("the song ended without playing a note")
+
+print("song data type:   %s" % type(song).__name__)
+print("import time:      %d ms" % import_ms)
+print("import heap peak: %d bytes" % import_heap)
+print("song load peak:   %d bytes" % load_heap)
+print("boot to 1st note: %d ms (includes play_song's 1s lead-in)" % first_note)
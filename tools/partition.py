@@ -0,0 +1,113 @@
+"""
+partition.py
+Splits one song into a song per board, for installations that need more voices than one Pico has. Run from the
+repository root with CPython:
+
+    python tools/partition.py morning_music 0,1 2,3
+    python tools/partition.py song.bin 0-3 4-7 --out build/
+
+Each board gets the tone generators listed for it (renumbered from 0, so "4-7" plays as channels 0-3 on that
+board) and every delay, so all boards see the same timing. Songs are read from a binary file or by name from
+songs.py, and written as build/<song>.board<N>.bin. Play board 0 with a SyncLeader and the rest with
+SyncFollowers to keep them together (see README).
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rpmidi import RPMidi
+
+
+def parse_group(text):
+    # "0,1,4-6" -> [0, 1, 4, 5, 6]
+    group = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            group.extend(range(int(first), int(last) + 1))
+        else:
+            group.append(int(part))
+    return group
+
+
+def partition(data, groups, start=0, velocity=False):
+    # Returns one bytearray per group of tone generators. data must have passed RPMidi.validate(),
+    # which also gives start (first event offset) and velocity.
+    boards = []
+    for group in groups:
+        board = bytearray(data[:start])
+        if start >= 6:
+            board[5] = len(group) # Tone generator count in the miditones header
+        boards.append(board)
+    pending = [0] * len(groups) # Delay not yet written to each board
+
+    def flush(b):
+        while pending[b]:
+            delay = min(pending[b], 0x7fff)
+            boards[b].append(delay >> 8)
+            boards[b].append(delay & 0xff)
+            pending[b] -= delay
+
+    index = start
+    while True:
+        opcode = data[index]
+        kind = opcode & 0xf0
+        if opcode == 0xf0 or opcode == 0xe0:
+            for b in range(len(groups)):
+                flush(b)
+                boards[b].append(opcode)
+            return boards
+        if opcode < 0x80:
+            for b in range(len(groups)):
+                pending[b] += (opcode << 8) | data[index + 1]
+            index += 2
+            continue
+
+        size = 1
+        if kind == 0x90:
+            size = 3 if velocity else 2
+        elif kind == 0xc0:
+            size = 2
+        generator = opcode & 0x0f
+        for b in range(len(groups)):
+            if generator in groups[b]:
+                flush(b)
+                boards[b].append(kind | groups[b].index(generator))
+                boards[b].extend(data[index + 1:index + size])
+        index += size
+
+
+def load_song(name):
+    if os.path.exists(name):
+        with open(name, "rb") as f:
+            return os.path.splitext(os.path.basename(name))[0], f.read()
+    from songs import SongData
+    return name, bytes(getattr(SongData(), name)())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a song into per-board songs by tone generator.")
+    parser.add_argument("song", help="binary song file, or the name of a song in songs.py")
+    parser.add_argument("groups", nargs="+", help="tone generators for each board, e.g. 0,1 or 0-3")
+    parser.add_argument("--out", default=os.path.join(ROOT, "build"), help="output directory (default: build/)")
+    args = parser.parse_args()
+
+    name, data = load_song(args.song)
+    groups = [parse_group(group) for group in args.groups]
+    info = RPMidi(leds=False).validate(data)
+    boards = partition(data, groups, info.start, info.velocity)
+
+    os.makedirs(args.out, exist_ok=True)
+    for b in range(len(boards)):
+        path = os.path.join(args.out, "%s.board%d.bin" % (name, b))
+        with open(path, "wb") as f:
+            f.write(boards[b])
+        print("board %d: generators %s, %d bytes -> %s" % (b, groups[b], len(boards[b]), os.path.relpath(path)))
+
+
+if __name__ == "__main__":
+    main()
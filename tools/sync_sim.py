@@ -0,0 +1,146 @@
+"""
+sync_sim.py
+Plays a song split across several simulated boards on one computer and reports how far apart they drift.
+Run from the repository root with CPython:
+
+    python tools/sync_sim.py --boards 0,1 2,3 --seconds 10 --late 40 --jitter 3
+
+Board 0 is the SyncLeader and every other board a SyncFollower, each on its own RPMidi instance and thread,
+connected by OS pipes standing in for UARTs. --late starts the followers that many ms after the leader, and
+--jitter delays each sync frame by a random 0-N ms on the way over. Skew is measured from the simulator's PWM
+log: every note-on is compared against the leader's timing at the same point in the score.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import rpmidi_sim
+from partition import load_song, parse_group, partition
+from rpmidi import RPMidi, SyncFollower, SyncLeader
+
+
+def truncate(data, start, velocity, seconds):
+    # Cut a song off after about this many seconds, silencing every generator at the end
+    index = start
+    elapsed = 0
+    while elapsed < seconds * 1000:
+        opcode = data[index]
+        if opcode == 0xf0 or opcode == 0xe0:
+            break
+        if opcode < 0x80:
+            elapsed += (opcode << 8) | data[index + 1]
+            index += 2
+        elif opcode & 0xf0 == 0x90:
+            index += 3 if velocity else 2
+        elif opcode & 0xf0 == 0xc0:
+            index += 2
+        else:
+            index += 1
+    return bytes(data[:index]) + bytes(range(0x80, 0x90)) + b"\xf0"
+
+
+def note_times(data, start, velocity):
+    # Score time in ms of every note-on, in order
+    times = []
+    index = start
+    elapsed = 0
+    while True:
+        opcode = data[index]
+        if opcode == 0xf0 or opcode == 0xe0:
+            return times
+        if opcode < 0x80:
+            elapsed += (opcode << 8) | data[index + 1]
+            index += 2
+        elif opcode & 0xf0 == 0x90:
+            times.append(elapsed)
+            index += 3 if velocity else 2
+        elif opcode & 0xf0 == 0xc0:
+            index += 2
+        else:
+            index += 1
+
+
+def relay(source, destination, jitter_ms, done):
+    # Forward sync frames, holding each one back by a random 0-jitter_ms
+    buf = bytearray(6)
+    while not done.is_set():
+        if source.any() >= 6:
+            source.readinto(buf, 6)
+            if jitter_ms:
+                time.sleep(random.uniform(0, jitter_ms) / 1000)
+            destination.write(buf)
+        else:
+            time.sleep(0.0005)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate several synced boards and report inter-board skew.")
+    parser.add_argument("--song", default="morning_music", help="binary song file, or a song in songs.py")
+    parser.add_argument("--boards", nargs="+", default=["0,1", "2,3"], help="tone generators per board")
+    parser.add_argument("--seconds", type=float, default=10, help="how much of the song to play")
+    parser.add_argument("--late", type=int, default=0, help="ms the followers start after the leader")
+    parser.add_argument("--jitter", type=float, default=0, help="max random delay per sync frame, in ms")
+    parser.add_argument("--period", type=int, default=100, help="ms between sync frames")
+    args = parser.parse_args()
+
+    sys.setswitchinterval(0.0002) # Boards share one interpreter, so let threads take turns quickly
+    name, data = load_song(args.song)
+    groups = [parse_group(group) for group in args.boards]
+    info = RPMidi(leds=False).validate(data)
+    data = truncate(data, info.start, info.velocity, args.seconds)
+    songs = partition(data, groups, info.start, info.velocity)
+
+    done = threading.Event()
+    leader_ports = []
+    followers = []
+    for b in range(1, len(groups)):
+        leader_end, relay_in = rpmidi_sim.pipe_pair()
+        relay_out, follower_end = rpmidi_sim.pipe_pair()
+        threading.Thread(target=relay, args=(relay_in, relay_out, args.jitter, done), daemon=True).start()
+        leader_ports.append(leader_end)
+        followers.append(SyncFollower(follower_end, period_ms=args.period))
+    syncs = [SyncLeader(leader_ports, args.period)] + followers
+
+    # Pins 100, 101, ... for board 1, 200, 201, ... for board 2 and so on, to tell boards apart in the log
+    boards = [RPMidi(pins=[100 * b + i for i in range(len(groups[b]))], leds=False) for b in range(len(groups))]
+    rpmidi_sim.log = []
+    threads = [threading.Thread(target=boards[b].play_song, args=(songs[b],), kwargs={"sync": syncs[b]}) for b in range(len(groups))]
+    threads[0].start()
+    time.sleep(args.late / 1000)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+
+    # Each note-on's offset from its score time; a board's skew is how that differs from the leader's
+    offsets = []
+    for b in range(len(groups)):
+        onsets = [t for t, pin, kind, value in rpmidi_sim.log if kind == "freq" and pin // 100 == b]
+        score = note_times(songs[b], info.start, info.velocity)
+        offsets.append([(s, onset / 1000 - s) for s, onset in zip(score, onsets)])
+
+    leader = offsets[0]
+    print("leader: %d notes, %d sync frames sent, slept %d ms, spun %d ms" % (
+        len(leader), syncs[0].sent, boards[0].stats["sleep_ms"], boards[0].stats["spin_ms"]))
+    for b in range(1, len(groups)):
+        skew = []
+        for s, offset in offsets[b]:
+            nearest = min(leader, key=lambda entry: abs(entry[0] - s))
+            skew.append(offset - nearest[1])
+        settled = skew[len(skew) // 2:]
+        print("board %d: %d notes, %d frames received, %d missed, skew first note %+.1f ms, max %.1f ms, mean |skew| over 2nd half %.2f ms, slept %d ms, spun %d ms" % (
+            b, len(skew), syncs[b].received, syncs[b].missed, skew[0], max(abs(x) for x in skew),
+            sum(abs(x) for x in settled) / max(1, len(settled)), boards[b].stats["sleep_ms"], boards[b].stats["spin_ms"]))
+
+
+if __name__ == "__main__":
+    main()